@@ -1,38 +1,105 @@
 '''This module creates the flattened hierarchy table from SAP BW'''
 
+import re
 import json
+import logging
+import string
 import pkg_resources
 import pandas as pd
+from sqlalchemy import text
 from hana2py import utilities as u
 
+QUERY_TEMPLATES = tuple(
+    string.Template(query) for query in u.get_sql_queries(
+        pkg_resources.resource_filename(
+            'hana2py', 'create_table_base_query.sql')))
+WHITESPACE = re.compile(r'\s+')
+# Hana has no WITH RECURSIVE, SQL Server neither has the keyword nor allows
+# a CTE inside a derived table.
+RECURSIVE_CTE_UNSUPPORTED = ('hana', 'mssql')
+
+logger = logging.getLogger(__name__)
+
+NODE_TEXT_HEADER = 'select *, case when node_text is null then case\n'
+NODE_TEXT_FOOTER = '\t\telse null end \n\t else node_text end as NODETEXT'
+
+
 class HierarchyTable():
     """
     Class to generate a flattened hierarchy table from a hierarchy in SAP BW.
+
+    The levels are flattened with one LEFT OUTER JOIN per level by default.
+    Set use_hierarchy_functions on Hana 2.0 SPS03+ to flatten them with the
+    HIERARCHY_ANCESTORS function instead; it is not yet verified against a
+    live Hana and, unlike the joins, skips nodes unreachable from level 1.
+    Set use_recursive_cte for databases that support WITH RECURSIVE, a
+    ValueError is raised on Hana and SQL Server. Set dump_sql to write the
+    generated query to create_<table>_query.sql in the working directory.
     """
 
     def __init__(self, hierarchy, generated_table_schema, engine,
-                 hierarchy_version='data/hierarchy_version.json'):
+                 hierarchy_version='data/hierarchy_version.json',
+                 use_recursive_cte=False, use_hierarchy_functions=False,
+                 dump_sql=False):
 
         self.hierarchy = hierarchy
         self.engine = engine
         self.generated_table_schema = generated_table_schema
         self.hierarchy_version = hierarchy_version
+        self.use_recursive_cte = use_recursive_cte
+        self.dump_sql = dump_sql
+        self.use_hierarchy_functions = use_hierarchy_functions
+        self._check_flatten_options()
 
         with open(self.hierarchy_version, 'r') as hierarchy_file:
             hierarchy_info = json.load(hierarchy_file)
 
-        self._query_file = pkg_resources.resource_filename(
-            'hana2py', 'create_table_base_query.sql')
-
         self._hieid = hierarchy_info.get(self.hierarchy).get('hieid')
+        # Hana does not take bind parameters in DDL, so the CREATE TABLE
+        # statements embed HIEID as an escaped literal.
+        self._hieid_literal = "'{}'".format(self._hieid.replace("'", "''"))
         self.schema_name = hierarchy_info.get(self.hierarchy).get('schema_name')
         self.table_name = hierarchy_info.get(self.hierarchy).get('table_name')
         self.generated_table_name = (self.hierarchy + '_HIER').upper()
 
+        self._level_counts = self._load_level_histogram()
         self.highest_level = self._find_highest_level()
 
         self.create_hierarchy_table()
 
+    def _check_flatten_options(self):
+        """Reject flattening options the engine cannot run."""
+
+        if not self.use_recursive_cte:
+            return
+
+        if self.use_hierarchy_functions:
+            raise ValueError('use_recursive_cte and use_hierarchy_functions '
+                             'cannot both be set.')
+
+        dialect_name = self.engine.dialect.name
+        if dialect_name in RECURSIVE_CTE_UNSUPPORTED:
+            raise ValueError(f'use_recursive_cte is not supported by the '
+                             f'{dialect_name} dialect.')
+
+    def _load_level_histogram(self):
+        """Count the nodes on each level of this hierarchy
+
+        :return:
+            level_counts (dict): number of nodes keyed by level.
+        """
+
+        query = text(f'select TLEVEL, count(*) as N from {self.table_name} '
+                     'where HIEID = :hieid group by TLEVEL')
+
+        level_df = pd.read_sql(query, con=self.engine,
+                               params={'hieid': self._hieid})
+
+        level_counts = {int(level): int(n_row)
+                        for level, n_row in level_df.itertuples(index=False)}
+
+        return level_counts
+
     def _find_highest_level(self):
         """Identify the highest level that exists in this hierarchy
 
@@ -41,47 +108,50 @@ class HierarchyTable():
             will be the maximum column the flattened table expands to.
         """
 
-        level = 1
-        n_row = 1
+        highest_level = max(self._level_counts, default=0)
 
-        while n_row > 0:
+        return highest_level
 
-            query = f'select count(*) from {self.table_name}'\
-                    f'where HIEID = \'{self._hieid}\' ' \
-                    f'and TLEVEL = {level}'
 
-            n_df = pd.read_sql(query, con=self.engine)
-            n_row = int(n_df.loc[0][0])
-            level += 1
+    def _drop_table(self, conn, table_name):
+        """ Drop a generated table if exist.
 
-        highest_level = level-2
+        :param conn: open connection the drop is executed on.
+        :param table_name: name of the table in the generated schema.
+        :return:
+            dropped (bool): whether the table existed and was dropped.
+        """
 
-        return highest_level
+        if not self.engine.dialect.has_table(
+                conn, table_name, schema=self.generated_table_schema):
+            return False
 
+        query = QUERY_TEMPLATES[0].substitute(
+            generated_schema=self.generated_table_schema,
+            generated_table_name=table_name)
+        conn.execute(text(query))
 
+        return True
 
-    def _drop_table(self):
-        """ Drop the generated table if exist.
+    def _rename_table(self, conn, from_table, to_table):
+        """ Rename a table in the generated schema, Hana has its own
+        RENAME TABLE statement, other databases use ALTER TABLE.
         """
 
-        if self.engine.dialect.has_table(self.engine, self.generated_table_name):
-            query = u.get_sql_queries(self._query_file)[0]
-            query = query.replace('GENERATED_SCHEMA_HERE',
-                                  self.generated_table_schema)
-            query = query.replace('GENERATED_TABLE_NAME_HERE',
-                                  self.generated_table_name)
-
-            message = f'Old table {self.generated_table_name} has been dropped.'
-
-            u.execute_query(self.engine, query, message)
-        else:
-            print(f'Table {self.generated_table_name} does not exist, continue to create...')
+        template = QUERY_TEMPLATES[5 if self.engine.dialect.name == 'hana'
+                                   else 6]
+        query = template.substitute(
+            generated_schema=self.generated_table_schema,
+            from_table=from_table,
+            to_table=to_table)
+        conn.execute(text(query))
 
 
     def _get_left_joins(self):
 
-        left_join = ''
+        table_name = self.table_name
         highest_level = self.highest_level -1
+        left_joins = []
 
         for level in range(highest_level, 0, -1):
             if level == highest_level:
@@ -89,108 +159,186 @@ class HierarchyTable():
             else:
                 join_table = 'H' + str(level+1)
 
-            left_join += f'\tLEFT OUTER JOIN {self.table_name} H{level} ' \
-                f'ON H{level}.NODEID = {join_table}.PARENTID ' \
-                f'AND H{level}.HIEID = F.HIEID\n'
+            left_joins.append(
+                f'\tLEFT OUTER JOIN {table_name} H{level} '
+                f'ON H{level}.NODEID = {join_table}.PARENTID '
+                f'AND H{level}.HIEID = F.HIEID\n')
 
-        return left_join
+        return ''.join(left_joins)
 
 
     def _get_generated_loop(self):
-        generated_loop = ''
-        k = 0
-        for j in range(self.highest_level, 1, -1):
-            generated_loop += '(CASE F.TLEVEL\n'
+        highest_level = self.highest_level
+        cases = []
+
+        for k, j in enumerate(range(highest_level, 1, -1)):
+            whens = ''.join(
+                f'\t\tWHEN {highest_level - i + 1} THEN H{i + k}.NODENAME\n'
+                for i in range(1, j))
+            col_level = highest_level - j + 1
+
+            cases.append(f'(CASE F.TLEVEL\n{whens}'
+                         f'\tELSE \' \' END) AS L{col_level}')
+
+        return ',\n\t'.join(cases)
+
+    def _get_recursive_loops(self):
+        """Build the level columns carried through the recursive CTE, each
+        child copies its parent's columns and fills in the parent's level.
+        The anchor is every node without a parent in the hierarchy, so
+        orphans are kept with NULL ancestors like in the join cascade.
+
+        :return:
+            columns, anchor_loop, recursive_loop (str)
+        """
+        columns = []
+        anchor_loop = []
+        recursive_loop = []
+
+        for level in range(1, self.highest_level):
+            columns.append(f', L{level}')
+            anchor_loop.append(
+                f',\n\t\tCAST(CASE WHEN N.TLEVEL > {level} THEN NULL '
+                f'ELSE \' \' END AS VARCHAR(32)) AS L{level}')
+            recursive_loop.append(
+                f',\n\t\tCAST(CASE WHEN P.TLEVEL = {level} THEN P.NODENAME '
+                f'ELSE P.L{level} END AS VARCHAR(32))')
+
+        return ''.join(columns), ''.join(anchor_loop), ''.join(recursive_loop)
+
+    def _get_recursive_table_query(self):
+        columns, anchor_loop, recursive_loop = self._get_recursive_loops()
+
+        query = QUERY_TEMPLATES[3].substitute(
+            recursive_columns=columns,
+            anchor_loop=anchor_loop,
+            recursive_loop=recursive_loop,
+            hieid=self._hieid_literal,
+            main_table_name=self.table_name)
+
+        return query
+
+    def _get_ancestor_loop(self):
+        """Pivot the ancestors returned by HIERARCHY_ANCESTORS into one
+        column per level, the start node itself has a distance of 0."""
+        ancestor_loop = []
 
-            for i in range(1, j):
-                level = self.highest_level -i + 1
-                node_level = i+k
-                col_level = level - 1
-                generated_loop += f'\t\tWHEN {level} THEN H{node_level}.NODENAME\n'
+        for level in range(1, self.highest_level):
+            ancestor_loop.append(
+                f',\n\t\tCOALESCE(MAX(CASE WHEN HIERARCHY_DISTANCE <> 0 '
+                f'AND TLEVEL = {level} THEN NODENAME END), \' \') AS L{level}')
 
-            generated_loop += f'\tELSE \' \' END) AS L{col_level},\n\t'
+        return ''.join(ancestor_loop)
 
-            k = k+1
+    def _get_hierarchy_function_query(self):
+        query = QUERY_TEMPLATES[4].substitute(
+            ancestor_loop=self._get_ancestor_loop(),
+            hieid=self._hieid_literal,
+            main_table_name=self.table_name)
 
-        generated_loop = generated_loop[:-3]
-        return generated_loop
+        return query
 
     def _get_main_table_query(self):
-        query = u.get_sql_queries(self._query_file)[1]
+        if self.use_recursive_cte:
+            return self._get_recursive_table_query()
+
+        if self.use_hierarchy_functions:
+            return self._get_hierarchy_function_query()
+
         generated_loop = self._get_generated_loop()
         left_join = self._get_left_joins()
 
-        query = query.replace('GENERATED_SCHEMA_HERE', self.generated_table_schema)
-        query = query.replace('GENERATED_LOOP_HERE', generated_loop)
-        query = query.replace('LEFT_JOIN_HERE', left_join)
-        query = query.replace('HIEID_HERE', f'\'{self._hieid}\'')
-        query = query.replace('MAIN_TABLE_NAME_HERE', self.table_name)
-        query = query.replace('SCHEMA_NAME_HERE',
-                              self.schema_name)
-        query = query.replace('GENERATED_TABLE_NAME_HERE',
-                              self.generated_table_name)
+        query = QUERY_TEMPLATES[1].substitute(
+            generated_loop=generated_loop,
+            left_join=left_join,
+            hieid=self._hieid_literal,
+            main_table_name=self.table_name)
 
         return query
 
     def _get_node_text(self):
-        NODETEXT = f'select *, case when node_text is null then case\n'
+        NODETEXT = [NODE_TEXT_HEADER]
         for level in range(2, self.highest_level + 1):
-            tlevel = [str(level) if level > 9 else '0' + str(level)][0]
-            NODETEXT += f'\t\twhen tlevel=\'{tlevel}\' then t{level - 1}\n'
+            NODETEXT.append(f'\t\twhen tlevel=\'{level:02d}\' then t{level - 1}\n')
 
-        NODETEXT += '\t\telse null end \n\t else node_text end as NODETEXT'
+        NODETEXT.append(NODE_TEXT_FOOTER)
 
-        return NODETEXT
+        return ''.join(NODETEXT)
 
-    def _create_hierarchy_table_query(self):
-        select_text = ''
-        left_join_text = ''
+    def _create_hierarchy_table_query(self, table_name=None):
+        """Build the CREATE TABLE statement of the flattened hierarchy.
+
+        :param table_name: table to create, default generated_table_name.
+        """
+        table_name = table_name or self.generated_table_name
+        schema_name = self.schema_name
+        hieid = self._hieid_literal
+        select_texts = []
+        left_join_texts = []
 
         main_table_query = self._get_main_table_query()
-        query = u.get_sql_queries(self._query_file)[2]
 
         for level in range(1, self.highest_level):
-            select_text += f'\nt{level}.t as t{level},'
-            left_join_text += '\nLEFT JOIN (SELECT NODENAME, TXTLG as T ' \
-                              f'from "{self.schema_name}"."RSTHIERNODE" ' \
-                              f'where HIEID = \'{self._hieid}\' ' \
-                              f'and LANGU = \'E\') T{level} ' \
-                              f'ON T{level}.NODENAME = h.L{level}'
-
-        select_text = select_text[:-1]
+            select_texts.append(f'\nt{level}.t as t{level}')
+            left_join_texts.append('\nLEFT JOIN (SELECT NODENAME, TXTLG as T '
+                                   f'from "{schema_name}"."RSTHIERNODE" '
+                                   f'where HIEID = {hieid} '
+                                   f'and LANGU = \'E\') T{level} '
+                                   f'ON T{level}.NODENAME = h.L{level}')
+
+        select_text = ','.join(select_texts)
+        left_join_text = ''.join(left_join_texts)
         node_text = self._get_node_text()
 
-        query = query.replace('SELECT_TEXT_HERE', select_text)
-        query = query.replace('HIEID_HERE', '\'' + self._hieid + '\'')
-        query = query.replace('GENERATED_SCHEMA_HERE',
-                              self.generated_table_schema)
-        query = query.replace('GENERATED_TABLE_NAME_HERE',
-                              self.generated_table_name)
-        query = query.replace('LEFT_JOIN_TEXT_HERE', left_join_text)
-        query = query.replace('MAIN_TABLE_QUERY_HERE', main_table_query)
-        query = query.replace('SCHEMA_NAME_HERE', self.schema_name)
+        query = QUERY_TEMPLATES[2].substitute(
+            select_text=select_text,
+            hieid=hieid,
+            generated_schema=self.generated_table_schema,
+            generated_table_name=table_name,
+            left_join_text=left_join_text,
+            main_table_query=main_table_query,
+            schema_name=schema_name,
+            node_text_loop=node_text)
 
-        query = query.replace('NODE_TEXT_LOOP_HERE', node_text)
+        logger.debug('Generated SQL:\n%s', query)
 
-        query_file = 'create_{}_query.sql'.format(
-            self.generated_table_name.lower())
+        if self.dump_sql:
+            query_file = 'create_{}_query.sql'.format(
+                self.generated_table_name.lower())
 
-        with open(query_file, 'w+') as file:
-            file.write(query)
+            with open(query_file, 'w') as file:
+                file.write(query)
 
-        query = query.replace('\n', ' ').replace('\t', ' ')
+        query = WHITESPACE.sub(' ', query)
 
         return query
 
     def create_hierarchy_table(self):
-        """Create hierarchy table in Hana """
-
-        self._drop_table()
-
-        query = self._create_hierarchy_table_query()
-        message = f'Table {self.generated_table_name} has been created.'
+        """Create hierarchy table in Hana.
+
+        The table is first created under a _TMP name, only then is the old
+        table dropped and the new one renamed into place, so a failing
+        CREATE leaves the old table untouched and its error is raised. Hana
+        commits each DDL statement on its own, if the rename fails the new
+        table is left under the _TMP name. The steps are retried as a whole
+        if the connection is lost.
+        """
 
-        u.execute_query(self.engine, query, message)
+        table_name = self.generated_table_name
+        tmp_table_name = f'{table_name}_TMP'
+        query = self._create_hierarchy_table_query(tmp_table_name)
+
+        def create_and_swap():
+            with self.engine.begin() as conn:
+                self._drop_table(conn, tmp_table_name)
+                conn.execute(text(query))
+                dropped = self._drop_table(conn, table_name)
+                self._rename_table(conn, tmp_table_name, table_name)
+            return dropped
+
+        if u.retry_on_broken_pipe(create_and_swap):
+            print(f'Old table {table_name} has been dropped.')
+        print(f'Table {table_name} has been created.')
 
 
     def get_hierarchy_table(self, top_n=None):
@@ -1,31 +1,75 @@
-DROP TABLE GENERATED_SCHEMA_HERE.GENERATED_TABLE_NAME_HERE;
+DROP TABLE ${generated_schema}.${generated_table_name};
 
 ( 
     SELECT DISTINCT
         F.NODENAME,
         F.TLEVEL,
 
-        GENERATED_LOOP_HERE
+        ${generated_loop}
 
-    FROM MAIN_TABLE_NAME_HERE F
+    FROM ${main_table_name} F
 
-    LEFT_JOIN_HERE
+    ${left_join}
 
-    WHERE F.HIEID = HIEID_HERE
+    WHERE F.HIEID = ${hieid}
 );
 
-CREATE TABLE GENERATED_SCHEMA_HERE.GENERATED_TABLE_NAME_HERE AS (
+CREATE TABLE ${generated_schema}.${generated_table_name} AS (
 
-NODE_TEXT_LOOP_HERE
+${node_text_loop}
 from (
 SELECT 	h.*, T.T as node_text,
-    SELECT_TEXT_HERE
+    ${select_text}
 
-FROM MAIN_TABLE_QUERY_HERE h
-LEFT JOIN (SELECT NODENAME, TXTLG as T from "SCHEMA_NAME_HERE"."RSTHIERNODE"
+FROM ${main_table_query} h
+LEFT JOIN (SELECT NODENAME, TXTLG as T from "${schema_name}"."RSTHIERNODE"
 where
-HIEID = HIEID_HERE and LANGU = 'E') T  ON T.NODENAME = h.NODENAME
-LEFT_JOIN_TEXT_HERE
+HIEID = ${hieid} and LANGU = 'E') T  ON T.NODENAME = h.NODENAME
+${left_join_text}
 ) main
 
 );
+
+(
+    WITH RECURSIVE HIER (NODEID, HIEID, NODENAME, TLEVEL ${recursive_columns}) AS (
+        SELECT N.NODEID, N.HIEID, N.NODENAME, N.TLEVEL ${anchor_loop}
+        FROM ${main_table_name} N
+        WHERE N.HIEID = ${hieid}
+        AND NOT EXISTS (SELECT 1 FROM ${main_table_name} R
+                        WHERE R.HIEID = N.HIEID AND R.NODEID = N.PARENTID)
+
+        UNION ALL
+
+        SELECT C.NODEID, C.HIEID, C.NODENAME, C.TLEVEL ${recursive_loop}
+        FROM ${main_table_name} C
+        INNER JOIN HIER P ON C.PARENTID = P.NODEID AND C.HIEID = P.HIEID
+    )
+    SELECT DISTINCT NODENAME, TLEVEL ${recursive_columns}
+    FROM HIER
+)
+;
+
+(
+    SELECT DISTINCT * FROM (
+        SELECT
+            MAX(CASE WHEN HIERARCHY_DISTANCE = 0 THEN NODENAME END) AS NODENAME,
+            MAX(CASE WHEN HIERARCHY_DISTANCE = 0 THEN TLEVEL END) AS TLEVEL
+            ${ancestor_loop}
+        FROM HIERARCHY_ANCESTORS (
+            SOURCE HIERARCHY (
+                SOURCE (SELECT NODEID AS NODE_ID, PARENTID AS PARENT_ID,
+                               NODENAME, TLEVEL
+                        FROM ${main_table_name}
+                        WHERE HIEID = ${hieid})
+                START WHERE TLEVEL = 1
+            )
+            START WHERE TLEVEL >= 1
+        )
+        GROUP BY START_RANK
+    )
+)
+;
+
+RENAME TABLE ${generated_schema}.${from_table} TO ${to_table};
+
+ALTER TABLE ${generated_schema}.${from_table} RENAME TO ${to_table}
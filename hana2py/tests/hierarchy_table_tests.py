@@ -0,0 +1,148 @@
+import re
+import sqlite3
+from types import SimpleNamespace
+from unittest import TestCase, mock
+from sqlalchemy import create_engine, event, inspect, text
+from hana2py.HierarchyTable import HierarchyTable
+
+# HIEID, NODEID, PARENTID, NODENAME, TLEVEL; node 8 is an orphan whose
+# parent 99 is missing, node 9 is its child.
+NODES = [('X', 1, 0, 'root', 1), ('X', 2, 1, 'a', 2), ('X', 3, 1, 'b', 2),
+         ('X', 4, 2, 'a1', 3), ('X', 5, 4, 'a11', 4), ('X', 6, 3, 'b1', 3),
+         ('X', 8, 99, 'orphan', 3), ('X', 9, 8, 'orphan1', 4),
+         ('Y', 7, 0, 'other', 1)]
+
+
+def make_hierarchy_table(dialect_name='sqlite', **options):
+    """Build a HierarchyTable that renders SQL without touching a database."""
+    table = HierarchyTable.__new__(HierarchyTable)
+    table.engine = SimpleNamespace(dialect=SimpleNamespace(name=dialect_name))
+    table.table_name = 'NODES'
+    table.schema_name = 'BW'
+    table.generated_table_schema = 'GEN'
+    table.generated_table_name = 'TEST_HIER'
+    table._hieid = 'X'
+    table._hieid_literal = "'X'"
+    table.highest_level = 4
+    table.dump_sql = False
+    table.use_recursive_cte = options.get('use_recursive_cte', False)
+    table.use_hierarchy_functions = options.get('use_hierarchy_functions',
+                                                False)
+    return table
+
+
+def make_sqlite_engine():
+    """SQLite engine with the GEN schema attached and an old TEST_HIER."""
+    engine = create_engine('sqlite://')
+
+    @event.listens_for(engine, 'connect')
+    def attach_schema(dbapi_connection, connection_record):
+        dbapi_connection.execute("attach database ':memory:' as GEN")
+
+    with engine.begin() as conn:
+        conn.execute(text('create table GEN.TEST_HIER (old_column int)'))
+    return engine
+
+
+def run_main_table_query(table, query=None, nodes=NODES):
+    con = sqlite3.connect(':memory:')
+    con.execute('create table NODES (HIEID, NODEID, PARENTID, NODENAME, TLEVEL)')
+    con.executemany('insert into NODES values (?, ?, ?, ?, ?)', nodes)
+    if query is None:
+        query = table._get_main_table_query()
+    return sorted(con.execute('select * from ' + query), key=str)
+
+
+def emulate_hierarchy_ancestors(query, nodes):
+    """Swap HIERARCHY_ANCESTORS for a table of the rows Hana returns, each
+    start node with itself at distance 0 and its ancestors below 0."""
+    by_id = {node[1]: node for node in nodes if node[0] == 'X'}
+    rows = []
+    for start_rank, start in enumerate(by_id.values()):
+        node, distance = start, 0
+        while node is not None:
+            rows.append(f"select {start_rank} as START_RANK, "
+                        f"{distance} as HIERARCHY_DISTANCE, "
+                        f"'{node[3]}' as NODENAME, {node[4]} as TLEVEL")
+            node, distance = by_id.get(node[2]), distance - 1
+
+    ancestors = '(' + ' union all '.join(rows) + ')'
+    return re.sub(r'HIERARCHY_ANCESTORS \(.*?\n        \)',
+                  ancestors, query, flags=re.S)
+
+
+class Test(TestCase):
+    """
+    Test the SQL generated by the HierarchyTable module
+    """
+
+    def test_join_cascade_is_default(self):
+        query = make_hierarchy_table()._get_main_table_query()
+        assert 'LEFT OUTER JOIN NODES H3 ON H3.NODEID = F.PARENTID' in query
+        assert 'WITH RECURSIVE' not in query
+
+    def test_recursive_cte_matches_join_cascade(self):
+        table = make_hierarchy_table(use_recursive_cte=True)
+        query = table._get_main_table_query()
+        assert 'WITH RECURSIVE HIER' in query
+        assert 'L3' in query and 'L4' not in query
+        assert run_main_table_query(table) == \
+            run_main_table_query(make_hierarchy_table())
+
+    def test_recursive_cte_rejects_unsupported_dialects(self):
+        for dialect_name in ('hana', 'mssql'):
+            table = make_hierarchy_table(dialect_name, use_recursive_cte=True)
+            with self.assertRaises(ValueError):
+                table._check_flatten_options()
+
+    def test_recursive_cte_rejects_hierarchy_functions(self):
+        table = make_hierarchy_table(use_recursive_cte=True,
+                                     use_hierarchy_functions=True)
+        with self.assertRaises(ValueError):
+            table._check_flatten_options()
+
+    def test_hierarchy_functions_query(self):
+        table = make_hierarchy_table(use_hierarchy_functions=True)
+        query = table._get_main_table_query()
+        assert 'HIERARCHY_ANCESTORS' in query
+        assert 'START WHERE TLEVEL = 1' in query
+        assert 'GROUP BY START_RANK' in query
+        assert "WHERE HIEID = 'X'" in query
+        assert "COALESCE(MAX(CASE WHEN HIERARCHY_DISTANCE <> 0 AND " \
+               "TLEVEL = 3 THEN NODENAME END), ' ') AS L3" in query
+        assert 'L4' not in query
+
+    def test_hierarchy_functions_pivot_matches_join_cascade(self):
+        nodes = [node for node in NODES if node[3][:6] != 'orphan']
+        table = make_hierarchy_table(use_hierarchy_functions=True)
+        query = emulate_hierarchy_ancestors(table._get_main_table_query(),
+                                            nodes)
+        assert run_main_table_query(table, query, nodes) == \
+            run_main_table_query(make_hierarchy_table(), nodes=nodes)
+
+    def test_failing_create_keeps_old_table(self):
+        table = make_hierarchy_table()
+        table.engine = make_sqlite_engine()
+        with mock.patch.object(table, '_create_hierarchy_table_query',
+                               return_value='create table GEN.TEST_HIER_TMP '
+                                            'as select * from MISSING'):
+            with self.assertRaises(Exception):
+                table.create_hierarchy_table()
+
+        columns = inspect(table.engine).get_columns('TEST_HIER', schema='GEN')
+        assert [column['name'] for column in columns] == ['old_column']
+        assert not inspect(table.engine).has_table('TEST_HIER_TMP',
+                                                   schema='GEN')
+
+    def test_create_replaces_old_table(self):
+        table = make_hierarchy_table()
+        table.engine = make_sqlite_engine()
+        with mock.patch.object(table, '_create_hierarchy_table_query',
+                               return_value='create table GEN.TEST_HIER_TMP '
+                                            'as select 1 as new_column'):
+            table.create_hierarchy_table()
+
+        columns = inspect(table.engine).get_columns('TEST_HIER', schema='GEN')
+        assert [column['name'] for column in columns] == ['new_column']
+        assert not inspect(table.engine).has_table('TEST_HIER_TMP',
+                                                   schema='GEN')
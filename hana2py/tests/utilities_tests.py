@@ -1,7 +1,8 @@
 import warnings
-from unittest import TestCase
+from unittest import TestCase, mock
 from dotenv import load_dotenv
 import pandas as pd
+from sqlalchemy import create_engine
 from hana2py import utilities as u
 
 load_dotenv()
@@ -19,6 +20,11 @@ class Test(TestCase):
         print(millify_num)
         assert millify_num == '5k'
 
+    def test_millify_array_series(self):
+        nums = IRIS.sepal_length.head(3) * [1, 1e3, 1e6]
+        millify_nums = u.millify_array(nums)
+        assert millify_nums.tolist() == ['5', '5k', '5mn']
+
     def test_get_hana_connection_details(self):
         user, pwd, host, port = u.get_hana_connection_details('user',
                                                               'password',
@@ -46,3 +52,36 @@ class Test(TestCase):
         server = None
         with self.assertRaises(Exception):
             u.create_sqlserver_engine(server, True)
+
+    def test_to_sql_with_progress_inserts_all_rows(self):
+        df = pd.concat([IRIS] * 10, ignore_index=True)
+        for supports_multivalues_insert in (True, False):
+            engine = create_engine('sqlite://')
+            engine.dialect.supports_multivalues_insert = \
+                supports_multivalues_insert
+            u.to_sql_with_progress(df, engine, None, 'iris', chunksize=1000)
+            n_rows = pd.read_sql('select count(*) from iris', engine).iloc[0, 0]
+            assert n_rows == len(df)
+
+    def test_retry_on_broken_pipe(self):
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise Exception('BrokenPipeError: connection lost')
+            return 'done'
+
+        with mock.patch('time.sleep'):
+            assert u.retry_on_broken_pipe(flaky) == 'done'
+            assert len(calls) == 3
+
+            with self.assertRaises(ValueError):
+                u.retry_on_broken_pipe(mock.Mock(side_effect=ValueError))
+
+    def test_execute_query_raises_on_shared_connection(self):
+        engine = create_engine('sqlite://')
+        with self.assertRaises(Exception):
+            with engine.begin() as conn:
+                u.execute_query(engine, 'create table t (x int)', '', conn=conn)
+                u.execute_query(engine, 'select * from missing', '', conn=conn)
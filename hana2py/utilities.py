@@ -1,7 +1,7 @@
 """This module are the general functions for using Hana and ODBC connector"""
 
 import os
-import math
+import time
 import urllib
 import warnings
 import numpy as np
@@ -9,10 +9,15 @@ import pandas as pd
 from tqdm import tqdm
 from datetime import datetime
 from dotenv import load_dotenv, find_dotenv
-from sqlalchemy import create_engine, exc
+from sqlalchemy import create_engine, exc, text
 from sqlalchemy.types import NVARCHAR
 
 MILLNAMES = ['', 'k', 'mn', 'bn', 'tn']
+MILLNAMES_ARRAY = np.array(MILLNAMES)
+# Bind parameters per multi-row INSERT, below the lowest common driver limit
+# (999 on older SQLite, 2100 on SQL Server).
+MAX_BIND_PARAMS = 999
+MAX_ATTEMPTS = 3
 
 def load_env():
     """ Load .env file into namespace
@@ -127,7 +132,7 @@ def create_sqlserver_engine(server: str, database: str, use_env: bool = True, \
     connection_string = f'mssql+pyodbc:///?odbc_connect={params}'
 
     try:
-        engine = create_engine(connection_string)
+        engine = create_engine(connection_string, fast_executemany=True)
         engine.connect()
     except exc.DBAPIError as e:
         print(f'Possible authentication error, '
@@ -146,53 +151,108 @@ def millify(num):
     Return:
         mn_name (str): A human readable number in form of a string, i.e. 12.3 mn
     """
-    num = float(num)
-    millidx = max(0, min(len(MILLNAMES)-1,
-                         int(math.floor(
-                             0 if num == 0 else math.log10(abs(num))/3))))
-    mn_name = '{:.0f}{}'.format(num / 10**(3 * millidx), MILLNAMES[millidx])
+    mn_name = str(millify_array([num])[0])
 
     return mn_name
 
 
+def millify_array(nums):
+    """
+    Convert an array of long numbers to a human readable form in one
+    vectorised pass, e.g. a numeric pandas Series.
+
+    Parameters:
+        nums (array-like): Long numbers such as [12345678, 1e3]
+    Return:
+        mn_names (np.ndarray): Human readable numbers as strings,
+        i.e. ['12mn', '1k']
+    """
+    nums = np.asarray(nums, dtype=np.float64)
+    abs_nums = np.abs(nums)
+    log_nums = np.log10(abs_nums, out=np.zeros_like(nums),
+                        where=(abs_nums != 0) & np.isfinite(abs_nums))
+    millidx = np.clip(np.floor(log_nums / 3),
+                      0, len(MILLNAMES) - 1).astype(np.int8)
+    mn_names = np.char.add(np.char.mod('%.0f', nums / 10.0 ** (3 * millidx)),
+                           MILLNAMES_ARRAY[millidx])
+
+    return mn_names
+
+
 def get_sql_queries(sql_file_path):
     """ Return sql queries in string format from a sql file
     Args:
         sql_file_path (str): path/to/sql/file.sql
     Returns:
-        sql_commands (str)
+        sql_commands (list of str)
     """
-    file_ = open(sql_file_path, 'r')
-    sql_file = file_.read()
+    with open(sql_file_path, 'r') as file_:
+        sql_file = file_.read()
     sql_commands = sql_file.split(';')
-    file_.close()
     return sql_commands
 
-def execute_query(engine, query, message, retry=0):
+def retry_on_broken_pipe(func, retry=0):
     """
     Description:
-        Execute query given the engine, allowing maximum of 3 retries if
-        database connection is lost.
+        Call func, calling it again with an exponential back off if the
+        database connection is lost, up to MAX_ATTEMPTS in total. Any other
+        error, or the last broken pipe, is raised.
+    Parameters:
+        func (callable): Function without arguments doing the database work.
+        retry (int): The number of attempts already made, default=0.
+    Returns:
+        The return value of func.
+    """
+
+    while True:
+        retry += 1
+        try:
+            return func()
+        except Exception as e:
+            if 'BrokenPipeError' not in str(e) or retry >= MAX_ATTEMPTS:
+                raise
+            print(f'BrokenPipeError: {e}. \nRetrying number {retry}.')
+            time.sleep(2 ** (retry - 1))
+
+def execute_query(engine, query, message, retry=0, conn=None):
+    """
+    Description:
+        Execute query given the engine, allowing maximum of 3 attempts if
+        database connection is lost, with an exponential back off between
+        them. The query is run as sqlalchemy.text, so :name tokens are bind
+        parameters; escape a literal colon as \\:.
     Parameters:
         engine (sqlalchemy.engine.base.Engine)
         query (str): The query to be executed.
         message (str): Message to print out if the transaction is successful.
+        retry (int): The number of attempts already made, default=0.
+        conn (sqlalchemy.engine.base.Connection): An open connection to
+        execute on instead of connecting through the engine. The caller
+        owns it and its transaction, so errors are raised rather than
+        printed or retried, letting the caller roll back.
     """
 
-    if retry < 3:
-        try:
-            con = engine.connect()
-            con.execute(query)
-            print(message)
-            con.close()
-        except Exception as e:
-            print(f'Unexpected error occurred. \n {e}')
-            retry += 1
-            if 'BrokenPipeError' in e.args[0]:
-                print(f'BrokenPipeError: {e}. \nRetrying number {retry}.')
-                execute_query(query, message, retry)
-            else:
-                print({e})
+    statement = text(query)
+
+    if conn is not None:
+        conn.execute(statement)
+        print(message)
+        return
+
+    if retry >= MAX_ATTEMPTS:
+        print(f'Query failed after {MAX_ATTEMPTS} attempts.')
+        return
+
+    def execute():
+        with engine.begin() as con:
+            con.execute(statement)
+
+    try:
+        retry_on_broken_pipe(execute, retry)
+    except Exception as e:
+        print(f'Unexpected error occurred. \n {e}')
+    else:
+        print(message)
 
 def analyse_dataframe(df: pd.DataFrame, n: int = 100):
     """
@@ -212,16 +272,18 @@ def analyse_dataframe(df: pd.DataFrame, n: int = 100):
     cat_cols = df.select_dtypes(['category']).columns
 
     print("*---------- Datetime ----------*")
+    date_min = df[date_cols].min()
+    date_max = df[date_cols].max()
+    date_nunique = df[date_cols].nunique()
     for date_col in date_cols:
         print(f"  The date range for {date_col} is "
-              f"{df[date_col].min()} - {df[date_col].max()}" \
-              f" with {len(df[date_col].drop_duplicates())} distinct values.")
+              f"{date_min[date_col]} - {date_max[date_col]}"
+              f" with {date_nunique[date_col]} distinct values.")
 
     print("*---------- Objects ----------*")
     for obj_col in obj_cols:
-        types = df[obj_col].drop_duplicates().tolist()
-        types = [t for t in types if t not in [None, np.nan]]
-        num = len(types)
+        types = df[obj_col].dropna().unique()
+        num = types.size
         if num > n:
             print(f"  {obj_col} has {num} items, the top {n} include \n"
                   f"\t {', '.join(types[:n])} \n")
@@ -231,27 +293,32 @@ def analyse_dataframe(df: pd.DataFrame, n: int = 100):
 
     print("*---------- Category ----------*")
     for cat_col in cat_cols:
-        types = df[cat_col].drop_duplicates().tolist()
-        num = len(types)
+        types = df[cat_col].cat.remove_unused_categories().cat.categories
+        num = types.size
         if num > n:
             print(f"  {cat_col} has {num} items, the top {n} include: \n "
-                  f"\t {', '.join(types)} \n")
+                  f"\t {', '.join(types[:n].astype(str))} \n")
         else:
             print(f"  {cat_col} has {num} items, include: \n "
-                  f"\t {', '.join(types)} \n")
+                  f"\t {', '.join(types.astype(str))} \n")
 
     print("*---------- Numeric ----------*")
     print(df[num_cols].describe())
 
 
-def chunker(seq, size):
-    return (seq[pos:pos + size] for pos in range(0, len(seq), size))
+def chunker(df, size):
+    """Yield positional row slices of a dataframe with at most size rows."""
+    return (df.iloc[pos:pos + size] for pos in range(0, len(df), size))
 
 def to_sql_with_progress(df, engine, schema, table_name, ind=False, 
                         dtypes=None, chunksize=10000, if_exist='append'):
     """
     Description:
         Insert a dataframe into the defined SQL database with a progress bar.
+        Each chunk is sent as multi-row INSERTs of at most MAX_BIND_PARAMS
+        values when the dialect supports them. Otherwise, and for pyodbc
+        engines with fast_executemany such as those from
+        create_sqlserver_engine, it is sent as one executemany.
     Parameters:
         df (pd.DataFrame): the dataframe to be inserted
         engine (sqlalchemy.engine.base.Engine): the connection to the database
@@ -261,67 +328,73 @@ def to_sql_with_progress(df, engine, schema, table_name, ind=False,
         if_exist (str): 'replace', or 'append'
     """
 
-    def df_to_sql(cdf, engine, schema, table_name, ind, if_exist, chunksize, 
-        dtype=None):
-        if dtype is None:
-            cdf.to_sql(
-                con=engine,
-                schema=schema,
-                name=table_name,
-                index=ind,
-                if_exists=if_exist)
-        else: 
-            cdf.to_sql(
-                con=engine,
-                schema=schema,
-                name=table_name,
-                index=ind,
-                if_exists=if_exist,
-                dtype=dtypes)
-
-        progress_bar.update(chunksize)
+    dialect = engine.dialect
+    if dialect.supports_multivalues_insert and \
+            not getattr(dialect, 'fast_executemany', False):
+        method = 'multi'
+        n_params = len(df.columns) + (df.index.nlevels if ind else 0)
+        rows_per_insert = max(1, MAX_BIND_PARAMS // max(1, n_params))
+    else:
+        method = None
+        rows_per_insert = None
+
+    def df_to_sql(cdf):
+        cdf.to_sql(
+            con=engine,
+            schema=schema,
+            name=table_name,
+            index=ind,
+            if_exists=if_exist,
+            dtype=dtypes,
+            method=method,
+            chunksize=rows_per_insert)
+
+        progress_bar.update(len(cdf))
 
     with tqdm(total=len(df)) as progress_bar:
-        if dtypes is None:
-            for i, cdf in enumerate(chunker(df, chunksize)):
-                try:
-                    df_to_sql(
-                        cdf, engine, schema, table_name, ind, if_exist, 
-                        chunksize)
-                except Exception as error:
-                    if 'BrokenPipeError' in error.args[0]:
-                        print(f'BrokenPipeError: {error}. \n Retrying...')
-                        df_to_sql(
-                            cdf, engine, schema, table_name, ind, if_exist, 
-                            chunksize)
-                    else:
-                        print(f'Unexpected error occurred: {error}')
+        for cdf in chunker(df, chunksize):
+            try:
+                df_to_sql(cdf)
+            except Exception as error:
+                if 'BrokenPipeError' in str(error):
+                    print(f'BrokenPipeError: {error}. \n Retrying...')
+                    df_to_sql(cdf)
+                else:
+                    print(f'Unexpected error occurred: {error}')
+
+
+def read_sql_with_progress(query, engine, chunksize=10000, dtype_backend=None):
+    """
+    Description:
+        Read the result of a query into a dataframe in chunks with a
+        progress bar.
+    Parameters:
+        query (str): the query to be executed
+        engine (sqlalchemy.engine.base.Engine): the connection to the database
+        chunksize (int): the number of rows fetched each time, default=10000
+        dtype_backend (str): 'pyarrow' or 'numpy_nullable' to read each chunk
+        with that dtype backend, requires pandas >= 2.0. Arrow strings use
+        far less memory than object columns on text-heavy results.
+    Returns:
+        df (pd.DataFrame)
+    """
 
-        else:
-            for i, cdf in enumerate(chunker(df, chunksize)):
-                try:
-                    df_to_sql(
-                        cdf, engine, schema, table_name, ind, if_exist, 
-                        chunksize, dtypes)
-                except Exception as error:
-                    if 'BrokenPipeError' in error.args[0]:
-                        print(f'BrokenPipeError: {error}. \n Retrying...')
-                        df_to_sql(
-                            cdf, engine, schema, table_name, ind, if_exist, 
-                            chunksize, dtypes)
-                    else:
-                        print(f'Unexpected error occurred: {error}')
-
-
-def read_sql_with_progress(query, engine, chunksize=10000):
-
-    chunks = pd.read_sql(query, con=engine, chunksize=chunksize)
-
-    df = pd.DataFrame()
-    for chunk in tqdm(chunks):
-        df = pd.concat([df, chunk])
-
-    return df
+    read_kwargs = {}
+    if dtype_backend is not None:
+        read_kwargs['dtype_backend'] = dtype_backend
+
+    chunks = pd.read_sql(query, con=engine, chunksize=chunksize, **read_kwargs)
+
+    parts = []
+    with tqdm(unit='rows') as progress_bar:
+        for chunk in chunks:
+            parts.append(chunk)
+            progress_bar.update(len(chunk))
+
+    if not parts:
+        return pd.DataFrame()
+
+    return pd.concat(parts, ignore_index=True)
 
 
 if __name__ == "__main__":